@@ -11,22 +11,34 @@ from __future__ import annotations
 
 import os
 import sys
+from collections import OrderedDict
 from typing import List, Tuple
 
 import cv2
 import numpy as np
-from PyQt5.QtCore import QPointF, Qt
+from PyQt5 import sip
+from PyQt5.QtCore import (
+    QObject,
+    QPointF,
+    QRunnable,
+    Qt,
+    QThreadPool,
+    QTimer,
+    pyqtSignal,
+)
 from PyQt5.QtGui import (
     QImage,
     QPainter,
     QPainterPath,
     QPen,
     QPixmap,
+    QTransform,
 )
 from PyQt5.QtWidgets import (
     QApplication,
     QFileDialog,
     QLabel,
+    QGraphicsPathItem,
     QGraphicsPixmapItem,
     QGraphicsScene,
     QGraphicsView,
@@ -39,11 +51,59 @@ from PyQt5.QtWidgets import (
     QMainWindow,
 )
 
+try:  # Optional: JIT-compiled bbox kernel
+    from numba import njit
+except ImportError:
+    njit = None
+
 # ---------------------------------------------------------------------------
 # Type aliases
 # ---------------------------------------------------------------------------
 Point = Tuple[int, int]
 
+# Number of decoded images (array + pixmap) kept for quick reloads
+IMAGE_CACHE_SIZE = 4
+
+# Wheel zoom: each step scales by ZOOM_STEP, clamped to +/- MAX_ZOOM_LEVEL
+ZOOM_STEP = 1.25
+MAX_ZOOM_LEVEL = 20
+
+
+# ---------------------------------------------------------------------------
+# Numeric kernels
+# ---------------------------------------------------------------------------
+if njit is not None:
+
+    @njit(cache=True, boundscheck=False)
+    def _bboxes_norm(pts, offs, img_w, img_h, out):
+        """
+        Write normalised ``(cx, cy, bw, bh)`` for every polygon into *out*.
+
+        Polygon ``i`` spans rows ``offs[i]:offs[i + 1]`` of *pts*.
+        """
+        for i in range(len(offs) - 1):
+            mnx = mny = np.inf
+            mxx = mxy = -np.inf
+            for j in range(offs[i], offs[i + 1]):
+                x = pts[j, 0]
+                y = pts[j, 1]
+                if x < mnx:
+                    mnx = x
+                if x > mxx:
+                    mxx = x
+                if y < mny:
+                    mny = y
+                if y > mxy:
+                    mxy = y
+            # Same operation order as the NumPy path, so output matches
+            out[i, 0] = (mnx + mxx) * 0.5 / img_w
+            out[i, 1] = (mny + mxy) * 0.5 / img_h
+            out[i, 2] = (mxx - mnx) / img_w
+            out[i, 3] = (mxy - mny) / img_h
+
+else:
+    _bboxes_norm = None
+
 
 class ZoomableGraphicsView(QGraphicsView):
     """
@@ -54,10 +114,24 @@ class ZoomableGraphicsView(QGraphicsView):
         super().__init__(scene)
         self._app = parent_app
 
+        # Precomputed transforms per discrete zoom level (no drift)
+        self._zoom_level = 0
+        self._zoom_transforms = {
+            i: QTransform.fromScale(ZOOM_STEP**i, ZOOM_STEP**i)
+            for i in range(-MAX_ZOOM_LEVEL, MAX_ZOOM_LEVEL + 1)
+        }
+
         self.setRenderHint(QPainter.Antialiasing)
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
         self.setDragMode(QGraphicsView.ScrollHandDrag)
 
+    def reset_zoom(self) -> None:
+        """
+        Return to the unscaled zoom level.
+        """
+        self._zoom_level = 0
+        self.resetTransform()
+
     # ---------------------------------------------------------------------
     # Event handlers
     # ---------------------------------------------------------------------
@@ -73,8 +147,13 @@ class ZoomableGraphicsView(QGraphicsView):
         """
         Zoom in/out keeping the cursor position fixed.
         """
-        factor = 1.25 if event.angleDelta().y() > 0 else 1 / 1.25
-        self.scale(factor, factor)
+        step = 1 if event.angleDelta().y() > 0 else -1
+        level = max(
+            -MAX_ZOOM_LEVEL, min(MAX_ZOOM_LEVEL, self._zoom_level + step)
+        )
+        if level != self._zoom_level:
+            self._zoom_level = level
+            self.setTransform(self._zoom_transforms[level])
 
     def mousePressEvent(self, event):  
         """
@@ -86,6 +165,48 @@ class ZoomableGraphicsView(QGraphicsView):
         super().mousePressEvent(event)
 
 
+class SaveMaskSignals(QObject):
+    """
+    Signals emitted by :class:`SaveMaskWorker`.
+    """
+
+    finished = pyqtSignal(str, bool)  # save path, success
+
+
+class SaveMaskWorker(QRunnable):
+    """
+    Rasterize polygons into a binary mask and write it off the GUI thread.
+    """
+
+    def __init__(
+        self,
+        polygons: List[np.ndarray],
+        height: int,
+        width: int,
+        save_path: str,
+    ) -> None:
+        super().__init__()
+        self.polygons = polygons
+        self.height = height
+        self.width = width
+        self.save_path = save_path
+        self.signals = SaveMaskSignals()
+
+    def run(self) -> None:
+        """
+        Fill and save the mask; OpenCV releases the GIL while doing so.
+        """
+        mask = np.zeros((self.height, self.width), dtype=np.uint8)
+        cv2.fillPoly(mask, self.polygons, 255)
+        try:
+            ok = cv2.imwrite(
+                self.save_path, mask, [cv2.IMWRITE_PNG_COMPRESSION, 1]
+            )
+        except cv2.error:  # e.g. unsupported extension
+            ok = False
+        self.signals.finished.emit(self.save_path, bool(ok))
+
+
 class SegmentationApp(QMainWindow):
     """
     GUI application for drawing regions and exporting annotations.
@@ -101,10 +222,26 @@ class SegmentationApp(QMainWindow):
         # Runtime state --------------------------------------------------
         self.current_points: List[Point] = []
         self.preview_item = None  # QGraphicsPathItem preview
-        self.annotations: List[Tuple[List[Point], int]] = []
+        self._preview_path = QPainterPath()
+        self._preview_drawn = 0  # current_points already on the preview path
+        self._preview_dirty = False  # a preview flush is already scheduled
+        # Committed annotations as structure-of-arrays: polygon ``i`` owns
+        # rows ``_offsets[i]:_offsets[i + 1]`` of ``_pts_flat`` and has
+        # class ``_classes[i]``.  Vertices are int16 when the image allows.
+        # ``_pts_flat`` is preallocated; only its first ``_pts_size`` rows
+        # are in use and it doubles when full.
+        self._pts_flat: np.ndarray = np.empty((256, 2), dtype=np.int32)
+        self._pts_size = 0
+        self._offsets: np.ndarray = np.zeros(1, dtype=np.int32)
+        self._classes: np.ndarray = np.empty(0, dtype=np.int32)
+        self._committed_items: List[QGraphicsPathItem] = []  # red outlines
         self.image: np.ndarray | None = None
         self.image_path: str = ""
         self.pixmap_item = None  # QGraphicsPixmapItem
+        # (path, mtime) -> (image, pixmap), least recently used first
+        self._img_cache: OrderedDict[
+            Tuple[str, float], Tuple[np.ndarray, QPixmap]
+        ] = OrderedDict()
 
         # Scene & view ---------------------------------------------------
         self.scene = QGraphicsScene()
@@ -176,99 +313,184 @@ class SegmentationApp(QMainWindow):
         if not path:
             return
 
-        img_bgr = cv2.imread(path)
-        if img_bgr is None:
-            QMessageBox.warning(self, "Error", "No se pudo leer la imagen.")
-            return
+        try:
+            key = (path, os.path.getmtime(path))
+        except OSError:
+            key = None
+
+        cached = self._img_cache.get(key) if key is not None else None
+        if cached is not None:
+            self._img_cache.move_to_end(key)
+            image, pixmap = cached
+        else:
+            decoded = self._decode_image(path)
+            if decoded is None:
+                QMessageBox.warning(
+                    self, "Error", "No se pudo leer la imagen."
+                )
+                return
+            image, pixmap = decoded
+            if key is not None:
+                self._img_cache[key] = decoded
+                if len(self._img_cache) > IMAGE_CACHE_SIZE:
+                    self._img_cache.popitem(last=False)
 
         self.image_path = path
-        self.image = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+        self.image = image
+
+        # Halve the vertex storage when coordinates fit in 16 bits
+        if max(image.shape[:2]) < 32768:
+            self._pts_flat = np.empty((256, 2), dtype=np.int16)
+
+        self.pixmap_item = QGraphicsPixmapItem(pixmap)
+        self.scene.addItem(self.pixmap_item)
+        self.view.reset_zoom()
 
-        height, width, _ = self.image.shape
+    def _decode_image(self, path: str) -> Tuple[np.ndarray, QPixmap] | None:
+        """
+        Decode *path* and upload it as a pixmap, or return None on failure.
+        """
+        # Read the bytes ourselves: one open, and safe for Unicode paths
+        try:
+            buf = np.fromfile(path, dtype=np.uint8)
+        except OSError:
+            buf = np.empty(0, dtype=np.uint8)
+        image = cv2.imdecode(buf, cv2.IMREAD_COLOR) if buf.size else None
+        if image is None:
+            return None
+
+        # Only the shape is used downstream, so keep OpenCV's BGR order
+        if not image.flags["C_CONTIGUOUS"]:
+            image = np.ascontiguousarray(image)
+
+        # Wrap the array without copying.  The QImage only lives until
+        # QPixmap.fromImage has copied it, and *image* outlives that call.
+        height, width, _ = image.shape
         qimg = QImage(
-            self.image.data,
+            sip.voidptr(image.ctypes.data),
             width,
             height,
-            3 * width,
-            QImage.Format_RGB888,
+            image.strides[0],
+            QImage.Format_BGR888,
         )
-        self.pixmap_item = QGraphicsPixmapItem(QPixmap.fromImage(qimg))
-        self.scene.addItem(self.pixmap_item)
-        self.view.resetTransform()
+        return image, QPixmap.fromImage(qimg)
 
     def delete_image(self) -> None:
         """
         Remove current image and annotations from the scene.
         """
         self.scene.clear()
-        self.annotations.clear()
+        self._pts_flat = np.empty((256, 2), dtype=np.int32)
+        self._pts_size = 0
+        self._offsets = np.zeros(1, dtype=np.int32)
+        self._classes = np.empty(0, dtype=np.int32)
+        self._committed_items.clear()
         self.current_points.clear()
         self.preview_item = None
+        self._preview_path = QPainterPath()
+        self._preview_drawn = 0
         self.image = None
         self.image_path = ""
         self.pixmap_item = None
 
+    def _polygons(self, copy: bool = False) -> List[np.ndarray]:
+        """
+        Return each committed polygon as an int32 slice of the vertices.
+
+        With *copy* the slices share one private int32 copy instead of
+        possibly viewing the live buffer.
+        """
+        flat = self._pts_flat[: self._pts_size].astype(np.int32, copy=copy)
+        offs = self._offsets
+        return [flat[offs[i]:offs[i + 1]] for i in range(len(offs) - 1)]
+
     # ------------------------------------------------------------------
     # Polygon drawing
     # ------------------------------------------------------------------
     def add_point(self, point: Point) -> None:
         """
-        Append a vertex and update the dashed preview path.
+        Append a vertex and schedule an update of the dashed preview path.
         """
         self.current_points.append(point)
 
-        # Remove previous preview
-        if self.preview_item is not None:
-            self.scene.removeItem(self.preview_item)
-
-        # Draw the updated open path
-        path = QPainterPath(QPointF(*self.current_points[0]))
-        for x, y in self.current_points[1:]:
-            path.lineTo(QPointF(x, y))
-        self.preview_item = self.scene.addPath(
-            path,
-            QPen(Qt.blue, 1, Qt.DashLine),
-        )
+        # Coalesce bursts of clicks into one redraw per event-loop pass
+        if not self._preview_dirty:
+            self._preview_dirty = True
+            QTimer.singleShot(0, self._flush_preview)
+
+    def _flush_preview(self) -> None:
+        """
+        Extend the preview path with the vertices added since the last flush.
+        """
+        self._preview_dirty = False
+        if not self.current_points:
+            return
+
+        if self.preview_item is None:
+            self._preview_path = QPainterPath(QPointF(*self.current_points[0]))
+            self.preview_item = self.scene.addPath(
+                self._preview_path,
+                QPen(Qt.blue, 1, Qt.DashLine),
+            )
+            self._preview_drawn = 1
+        # lineTo skips a point equal to the previous one, so count consumed
+        # vertices ourselves rather than using the path's element count
+        for x, y in self.current_points[self._preview_drawn:]:
+            self._preview_path.lineTo(QPointF(x, y))
+        self._preview_drawn = len(self.current_points)
+        self.preview_item.setPath(self._preview_path)
 
     def close_polygon(self) -> None:
         """
-        Close and commit the current polygon to *annotations*.
+        Close and commit the current polygon to the annotation arrays.
         """
         if len(self.current_points) < 3:
             return
 
-        # Draw permanent polygon
-        path = QPainterPath(QPointF(*self.current_points[0]))
-        for x, y in self.current_points[1:]:
-            path.lineTo(QPointF(x, y))
-        path.closeSubpath()
-        self.scene.addPath(path, QPen(Qt.red, 2))
+        # Turn the live preview into the permanent outline instead of
+        # copying its path into a second scene item.  After the flush the
+        # path traces every clicked vertex (lineTo only drops a point equal
+        # to the one right before it), so it just needs closing and a new pen.
+        self._flush_preview()
+        self._preview_path.closeSubpath()
+        self.preview_item.setPath(self._preview_path)
+        self.preview_item.setPen(QPen(Qt.red, 2))
+        self._committed_items.append(self.preview_item)
+        self.preview_item = None
 
-        class_id = self.class_spin.value()
-        self.annotations.append((self.current_points.copy(), class_id))
+        pts = np.asarray(self.current_points, dtype=np.int32)
+        start, end = self._pts_size, self._pts_size + len(pts)
+        if end > len(self._pts_flat):
+            capacity = max(2 * len(self._pts_flat), end)
+            grown = np.empty((capacity, 2), dtype=self._pts_flat.dtype)
+            grown[:start] = self._pts_flat[:start]
+            self._pts_flat = grown
+        info = np.iinfo(self._pts_flat.dtype)
+        self._pts_flat[start:end] = np.clip(pts, info.min, info.max)
+        self._pts_size = end
+        self._offsets = np.append(self._offsets, end)
+        self._classes = np.append(self._classes, self.class_spin.value())
 
         # Reset state
         self.current_points.clear()
-        if self.preview_item is not None:
-            self.scene.removeItem(self.preview_item)
-            self.preview_item = None
+        self._preview_path = QPainterPath()
+        self._preview_drawn = 0
 
     def clear_polygon(self) -> None:
         """
         Undo the last committed polygon or the live preview.
         """
-        if self.annotations:
-            self.annotations.pop()
-            # Remove the most recent red path (first non‑pixmap item)
-            for item in self.scene.items():
-                if not isinstance(item, QGraphicsPixmapItem):
-                    pen = item.pen() if hasattr(item, "pen") else None
-                    if pen and pen.color() == Qt.red:
-                        self.scene.removeItem(item)
-                        break
-        elif self.preview_item is not None:
-            self.scene.removeItem(self.preview_item)
-            self.preview_item = None
+        if len(self._classes):
+            self._offsets = self._offsets[:-1]
+            self._classes = self._classes[:-1]
+            self._pts_size = int(self._offsets[-1])
+            self.scene.removeItem(self._committed_items.pop())
+        elif self.current_points:
+            if self.preview_item is not None:
+                self.scene.removeItem(self.preview_item)
+                self.preview_item = None
+            self._preview_path = QPainterPath()
+            self._preview_drawn = 0
             self.current_points.clear()
 
     # ------------------------------------------------------------------
@@ -276,62 +498,80 @@ class SegmentationApp(QMainWindow):
     # ------------------------------------------------------------------
     def save_mask(self) -> None:
         """
-        Fill all polygons into a single-channel mask and save as PNG.
+        Fill all polygons into a single-channel mask and save it.
+
+        Rasterizing and encoding run in a :class:`SaveMaskWorker`.  PNG is
+        written with fast (level 1) deflate; a binary mask compresses almost
+        as well as at higher levels.  The PGM filter writes an uncompressed
+        ``.pgm`` instead.
         """
-        if self.image is None or not self.annotations:
+        if self.image is None or not len(self._classes):
             return
 
-        height, width = self.image.shape[:2]
-        mask = np.zeros((height, width), dtype=np.uint8)
-        for points, _ in self.annotations:
-            cv2.fillPoly(mask, [np.array(points, dtype=np.int32)], 1)
-
         base = os.path.splitext(os.path.basename(self.image_path))[0]
-        save_path, _ = QFileDialog.getSaveFileName(
+        save_path, selected = QFileDialog.getSaveFileName(
             self,
             "Guardar máscara",
             f"../datasets/{base}_mask.png",
+            "PNG (*.png);;PGM sin comprimir (*.pgm)",
         )
+        # The default name ends in .png; follow the chosen filter instead
+        if save_path and selected.startswith("PGM"):
+            save_path = os.path.splitext(save_path)[0] + ".pgm"
         if save_path:
-            cv2.imwrite(save_path, mask * 255)
-
-    @staticmethod
-    def _poly_to_bbox_norm(
-        points: List[Point], img_w: int, img_h: int
-    ) -> Tuple[float, float, float, float]:
-        """
-        Convert a polygon to a YOLO-style normalised bounding box.
-        """
-        xs, ys = zip(*points)
-        x_min, x_max = min(xs), max(xs)
-        y_min, y_max = min(ys), max(ys)
-        cx = (x_min + x_max) / 2.0 / img_w
-        cy = (y_min + y_max) / 2.0 / img_h
-        bw = (x_max - x_min) / img_w
-        bh = (y_max - y_min) / img_h
-        
-        return cx, cy, bw, bh
+            # The worker gets its own copy; later edits cannot race it
+            polygons = self._polygons(copy=True)
+            height, width = self.image.shape[:2]
+            worker = SaveMaskWorker(polygons, height, width, save_path)
+            worker.signals.finished.connect(self._on_mask_saved)
+            QThreadPool.globalInstance().start(worker)
+
+    def _on_mask_saved(self, save_path: str, ok: bool) -> None:
+        """
+        Report the result of a background mask save.
+        """
+        if ok:
+            self.statusBar().showMessage(
+                f"Máscara guardada: {save_path}", 5000
+            )
+        else:
+            QMessageBox.warning(
+                self, "Error", f"No se pudo guardar la máscara:\n{save_path}"
+            )
 
     def save_yolo(self):
         """
         Save the polygon as a YOLO-style annotation in a txt file.
         """
-        if self.image is None or not self.annotations:
+        if self.image is None or not len(self._classes):
             return
         
         h, w = self.image.shape[:2]
-        lines = []
-
-        for pts, class_id in self.annotations:
-            cx, cy, bw, bh = self._poly_to_bbox_norm(pts, w, h)
-            lines.append(f"{class_id} {cx:.6f} {cy:.6f} {bw:.6f} {bh:.6f}")
+        n = len(self._classes)
+
+        if _bboxes_norm is not None:
+            bboxes = np.empty((n, 4), dtype=np.float64)
+            _bboxes_norm(self._pts_flat, self._offsets, w, h, bboxes)
+        else:
+            # One reduction over all polygons instead of one call per polygon
+            size = np.array([w, h], dtype=np.float64)
+            starts = self._offsets[:-1]
+            used = self._pts_flat[: self._pts_size]
+            flat = used.astype(np.int32, copy=False)
+            mins = np.minimum.reduceat(flat, starts, axis=0)
+            maxs = np.maximum.reduceat(flat, starts, axis=0)
+            bboxes = np.hstack(
+                ((mins + maxs) * 0.5 / size, (maxs - mins) / size)
+            )
+        data = np.empty((n, 5), dtype=np.float64)
+        data[:, 0] = self._classes
+        data[:, 1:] = bboxes
 
         base = os.path.splitext(os.path.basename(self.image_path))[0]
         save_path, _ = QFileDialog.getSaveFileName(self, "Guardar etiqueta YOLO", f"../datasets/{base}.txt", "Texto (*.txt)")
 
         if save_path:
-            with open(save_path, 'w', encoding='utf-8') as f:
-                f.write("\n".join(lines))
+            np.savetxt(save_path, data, fmt="%d %.6f %.6f %.6f %.6f")
 
 
 if __name__ == "__main__":